@@ -4,8 +4,11 @@ from future.builtins import input, open
 import os
 import re
 import sys
+import time
+from datetime import datetime
 from functools import wraps
 from getpass import getpass, getuser
+from json import dumps
 from contextlib import contextmanager
 from posixpath import join
 
@@ -596,3 +599,250 @@ def all():
     """
     if create():
         deploy(first=True)
+
+
+##############
+# Monitoring #
+##############
+
+def status_script():
+    """
+    Returns a shell script that dumps the raw runtime state of every service
+    used by the project, one "@@section" marker before each of them.
+    """
+    pid_path = "%s/gunicorn.pid" % env.proj_path
+    sock_path = "%s/gunicorn.sock" % env.proj_path
+    db = env.proj_name
+    # Leave out this query's own backend and the locks it takes. Before
+    # PostgreSQL 9.2, pg_stat_activity has procpid and current_query
+    # instead of pid and state.
+    sql = ("SELECT "
+           "(SELECT count(*) FROM pg_stat_activity "
+           "WHERE datname = '%(db)s' AND %(active)s "
+           "AND %(pid)s <> pg_backend_pid()), "
+           "(SELECT count(*) FROM pg_stat_activity "
+           "WHERE datname = '%(db)s' AND %(pid)s <> pg_backend_pid()), "
+           "(SELECT count(*) FROM pg_locks "
+           "WHERE database = d.datid AND pid <> pg_backend_pid()), "
+           "(SELECT count(*) FROM pg_locks WHERE database = d.datid "
+           "AND NOT granted AND pid <> pg_backend_pid()), "
+           "d.blks_hit, d.blks_read "
+           "FROM pg_stat_database d WHERE d.datname = '%(db)s';")
+    sql_92 = sql % {"db": db, "pid": "pid", "active": "state = 'active'"}
+    sql_91 = sql % {"db": db, "pid": "procpid", "active":
+                    "current_query NOT IN ('<IDLE>', '<IDLE> in transaction')"}
+    psql = "sudo -u postgres psql -At -F ' ' -d %s -c" % db
+    # Sample /proc/<pid>/stat one second apart, since ps only reports
+    # the CPU usage averaged over the whole life of the process.
+    stat = "for p in $pids; do sed 's/ (.*) / /' /proc/$p/stat 2>&1; done"
+    # Errors are kept in each section, so the task can tell why a service
+    # is unavailable.
+    return "; ".join([
+        "pid=$(cat %s 2>/dev/null)" % pid_path,
+        "[ -n \"$pid\" ] && pids=$(ps -o pid= -p $pid --ppid $pid)",
+        "echo @@clock",
+        "getconf CLK_TCK",
+        "getconf PAGESIZE",
+        "echo @@uptime_before",
+        "cat /proc/uptime",
+        "echo @@gunicorn_before",
+        stat,
+        "sleep 1",
+        "echo @@uptime",
+        "cat /proc/uptime",
+        "echo @@gunicorn",
+        stat,
+        "if [ -z \"$pid\" ]; then echo 'Cannot read %s'; "
+        "elif [ -z \"$pids\" ]; then echo \"No process with pid $pid\"; fi"
+        % pid_path,
+        "echo @@socket",
+        "ss -xl 2>&1 | grep -F ' %s ' || echo 'Nothing listening on %s'"
+        % (sock_path, sock_path),
+        "echo @@nginx",
+        "curl -sSf -m 5 -H 'Host: %s' http://127.0.0.1/nginx_status 2>&1"
+        % env.domains[0],
+        "echo @@memcached",
+        "(exec 3<>/dev/tcp/127.0.0.1/11211 && "
+        "printf 'stats\\r\\nquit\\r\\n' >&3 && cat <&3) 2>&1",
+        "echo @@postgres",
+        "v=$(%s 'SHOW server_version_num' 2>&1)" % psql,
+        "if [ \"$v\" -ge 90200 ] 2>/dev/null; then %s \"%s\" 2>&1; "
+        "elif [ \"$v\" -ge 0 ] 2>/dev/null; then %s \"%s\" 2>&1; "
+        "else echo \"$v\"; fi" % (psql, sql_92, psql, sql_91),
+        "true",
+    ])
+
+
+def ratio(part, whole):
+    """
+    Returns ``part / whole`` rounded for display, or None if ``whole`` is 0.
+    """
+    return round(float(part) / whole, 4) if whole else None
+
+
+def parse_status(output):
+    """
+    Turns the output of ``status_script`` into a dict of metrics. Services
+    that didn't answer are reported as ``{"error": <first line of output>}``.
+    """
+    sections = {}
+    name = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("@@"):
+            name = line[2:]
+            sections[name] = []
+        elif line and name:
+            sections[name].append(line)
+    metrics = {"time": datetime.utcnow().isoformat() + "Z",
+               "host": env.host_string, "gunicorn": None, "socket": None,
+               "nginx": None, "memcached": None, "postgres": None}
+
+    # Lines of /proc/<pid>/stat without the command name, so that utime,
+    # stime and rss (fields 14, 15 and 24) end up at indexes 12, 13 and 22.
+    proc_stats = lambda name: dict((l.split()[0], l.split())
+                                   for l in sections.get(name, [])
+                                   if len(l.split()) > 22)
+    uptime = lambda name: float((sections.get(name) or ["0"])[0].split()[0])
+    clock = sections.get("clock", [])
+    ticks, page_size = map(int, clock) if len(clock) == 2 else (100, 4096)
+    before, after = proc_stats("gunicorn_before"), proc_stats("gunicorn")
+    elapsed = uptime("uptime") - uptime("uptime_before")
+    processes = [(pid, after[pid], before[pid])
+                 for pid in sorted(after, key=int) if pid in before]
+    if processes and elapsed > 0:
+        metrics["gunicorn"] = [{
+            "pid": int(pid),
+            "role": "worker" if new[2] in after else "master",
+            "cpu": round((sum(map(int, new[12:14])) -
+                          sum(map(int, old[12:14]))) * 100. /
+                         ticks / elapsed, 1),
+            "rss_kb": int(new[22]) * page_size // 1024,
+        } for pid, new, old in processes]
+
+    for line in sections.get("socket", []):
+        fields = line.split()
+        if "LISTEN" in fields:
+            i = fields.index("LISTEN")
+            metrics["socket"] = {"backlog": int(fields[i + 1]),
+                                 "max_backlog": int(fields[i + 2])}
+            break
+
+    nginx = " ".join(sections.get("nginx", []))
+    match = re.search(r"Active connections: (\d+).*?(\d+) (\d+) (\d+)\s+"
+                      r"Reading: (\d+) Writing: (\d+) Waiting: (\d+)", nginx)
+    if match:
+        keys = ("active", "accepts", "handled", "requests",
+                "reading", "writing", "waiting")
+        metrics["nginx"] = dict(zip(keys, map(int, match.groups())))
+
+    stats = dict(l.split()[1:3] for l in sections.get("memcached", [])
+                 if l.startswith("STAT ") and len(l.split()) == 3)
+    if stats:
+        hits, misses = int(stats["get_hits"]), int(stats["get_misses"])
+        metrics["memcached"] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": ratio(hits, hits + misses),
+            "evictions": int(stats["evictions"]),
+            "items": int(stats["curr_items"]),
+            "connections": int(stats["curr_connections"]),
+        }
+
+    for line in sections.get("postgres", []):
+        if re.match(r"^\d+( \d+){5}$", line):
+            active, conns, locks, waiting, hit, read = map(int, line.split())
+            metrics["postgres"] = {
+                "active": active,
+                "connections": conns,
+                "locks": locks,
+                "waiting_locks": waiting,
+                "cache_hit_ratio": ratio(hit, hit + read),
+            }
+            break
+
+    errors = {
+        "gunicorn": [l for l in sections.get("gunicorn", [])
+                     if len(l.split()) <= 22],
+        "socket": sections.get("socket", []),
+        "nginx": sections.get("nginx", []),
+        "memcached": [l for l in sections.get("memcached", [])
+                      if not l.startswith(("STAT ", "END"))],
+        "postgres": sections.get("postgres", []),
+    }
+    for name, lines in errors.items():
+        if metrics[name] is None:
+            metrics[name] = {"error": lines[0] if lines else "No output"}
+    return metrics
+
+
+def format_status(metrics):
+    """
+    Renders the metrics returned by ``parse_status`` as a compact table.
+    """
+    percent = lambda r: "n/a" if r is None else "%.1f%%" % (r * 100)
+    errors = dict((name, value["error"]) for name, value in metrics.items()
+                  if isinstance(value, dict) and "error" in value)
+    rows = []
+    if "gunicorn" not in errors:
+        for proc in metrics["gunicorn"]:
+            proc = dict(proc, mb=proc["rss_kb"] / 1024.)
+            rows.append(("gunicorn", "pid %(pid)-7s %(role)-6s  "
+                         "cpu %(cpu)5.1f%%  rss %(mb).1f MB" % proc))
+    if "socket" not in errors:
+        rows.append(("socket", "backlog %(backlog)s/%(max_backlog)s"
+                     % metrics["socket"]))
+    if "nginx" not in errors:
+        rows.append(("nginx", "active %(active)s  reading %(reading)s  "
+                     "writing %(writing)s  waiting %(waiting)s  "
+                     "requests %(requests)s" % metrics["nginx"]))
+    memcached = metrics["memcached"]
+    if "memcached" not in errors:
+        rows.append(("memcached", "hit ratio %s  evictions %s  items %s" % (
+            percent(memcached["hit_ratio"]), memcached["evictions"],
+            memcached["items"])))
+    pg = metrics["postgres"]
+    if "postgres" not in errors:
+        rows.append(("postgres", "active %s/%s  locks %s (%s waiting)  "
+                     "cache hit ratio %s" % (
+                         pg["active"], pg["connections"], pg["locks"],
+                         pg["waiting_locks"], percent(pg["cache_hit_ratio"]))))
+    for name in ("gunicorn", "socket", "nginx", "memcached", "postgres"):
+        if name in errors:
+            rows.append((name, red("unavailable: %s" % errors[name])))
+    lines = [blue("%(host)s  %(time)s" % metrics, bold=True)]
+    previous = None
+    for name, text in rows:
+        label = "" if name == previous else name
+        lines.append("%-10s %s" % (label, text))
+        previous = name
+    return "\n".join(lines)
+
+
+@task
+def status(watch=0, json=False):
+    """
+    Shows live gunicorn, nginx, memcached and PostgreSQL metrics.
+    Use ``watch`` to refresh every given number of seconds, and ``json``
+    to print each sample as a line of JSON instead of a table.
+    """
+    watch = float(watch)
+    json = str(json).lower() in ("true", "1", "yes")
+    if watch and len(env.all_hosts) > 1:
+        abort("status:watch only samples one host. Pick it with "
+              "fab status:watch=%g,hosts=<host>" % watch)
+    try:
+        while True:
+            with hide("stdout"):
+                output = sudo(status_script(), show=False)
+            metrics = parse_status(output)
+            if json:
+                print(dumps(metrics, sort_keys=True))
+            else:
+                _print(format_status(metrics))
+            sys.stdout.flush()
+            if not watch:
+                break
+            time.sleep(watch)
+    except KeyboardInterrupt:
+        pass